@@ -1,14 +1,24 @@
+from __future__ import annotations
+
 import argparse
+import functools
+import http.client
 import json
+import math
+import os
 import re
 import shutil
 import subprocess
 import sys
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import TYPE_CHECKING
 from urllib.parse import urlparse, unquote
 
-from PIL import Image
+if TYPE_CHECKING:
+    # Pillow wordt pas geïmporteerd als er een afbeelding verwerkt wordt; video heeft het niet nodig.
+    from PIL import Image
 
 
 PLATFORMS = {
@@ -21,15 +31,43 @@ PLATFORMS = {
 IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".webp"}
 VIDEO_EXTS = {".mp4", ".mov", ".m4v", ".webm"}
 
+FTYP_VIDEO_BRANDS = {
+    b"qt  ": ".mov",
+    b"isom": ".mp4",
+    b"iso2": ".mp4",
+    b"iso4": ".mp4",
+    b"iso5": ".mp4",
+    b"iso6": ".mp4",
+    b"mp41": ".mp4",
+    b"mp42": ".mp4",
+    b"avc1": ".mp4",
+    b"mmp4": ".mp4",
+    b"MSNV": ".mp4",
+    b"dash": ".mp4",
+    b"M4V ": ".m4v",
+    b"3gp4": ".mp4",
+    b"3gp5": ".mp4",
+    b"3gp6": ".mp4",
+}
+
+DOWNLOAD_CHUNK = 1 << 20
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = 60
+
+# Modes waarvoor resizen en daarna naar RGB omzetten exact hetzelfde geeft als andersom.
+DEFERRED_CONVERT_MODES = {"RGB", "L"}
+
+HW_ENCODERS = ["h264_nvenc", "h264_qsv", "h264_videotoolbox"]
+
+_KNOWN_DIRS: set[str] = set()
+
 
 def run(cmd: list[str]) -> None:
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
     if proc.returncode != 0:
         raise RuntimeError(
             "Command failed:\n"
             + " ".join(cmd)
-            + "\n\nSTDOUT:\n"
-            + proc.stdout
             + "\n\nSTDERR:\n"
             + proc.stderr
         )
@@ -49,6 +87,14 @@ def run_capture(cmd: list[str]) -> str:
     return proc.stdout.strip()
 
 
+def _ensure_dir(path: Path) -> None:
+    key = str(path)
+    if key in _KNOWN_DIRS:
+        return
+    path.mkdir(parents=True, exist_ok=True)
+    _KNOWN_DIRS.add(key)
+
+
 def clamp01(x: float) -> float:
     if x < 0.0:
         return 0.0
@@ -57,11 +103,21 @@ def clamp01(x: float) -> float:
     return x
 
 
+def non_negative_int(value: str) -> int:
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"geen geheel getal: {value}") from None
+    if n < 0:
+        raise argparse.ArgumentTypeError(f"moet 0 of groter zijn: {value}")
+    return n
+
+
 def guess_ext_from_url(url: str) -> str | None:
-    m = re.search(r"\.([a-zA-Z0-9]{2,5})(?:\?|$)", url)
-    if not m:
+    ext = os.path.splitext(urlparse(url).path)[1].lower()
+    if not 3 <= len(ext) <= 6 or not ext[1:].isascii() or not ext[1:].isalnum():
         return None
-    return "." + m.group(1).lower()
+    return ext
 
 
 def derive_input_basename(url: str) -> str:
@@ -79,11 +135,87 @@ def derive_input_basename(url: str) -> str:
     return stem if stem else "input"
 
 
-def download(url: str, dest: Path) -> None:
-    dest.parent.mkdir(parents=True, exist_ok=True)
-    req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-    with urllib.request.urlopen(req) as resp, open(dest, "wb") as f:
-        shutil.copyfileobj(resp, f)
+def sniff_ext(head: bytes) -> str | None:
+    if head.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    if head[4:8] == b"ftyp":
+        # Alleen bekende video brands; HEIC/AVIF stills en M4A audio gaan via detect_and_fix_extension.
+        return FTYP_VIDEO_BRANDS.get(head[8:12])
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return ".webm"
+    return None
+
+
+def open_url(url: str, offset: int = 0) -> http.client.HTTPResponse:
+    headers = {"User-Agent": "Mozilla/5.0"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT)
+
+
+def content_range_start(resp: http.client.HTTPResponse) -> int | None:
+    m = re.match(r"bytes\s+(\d+)-", resp.headers.get("Content-Range", ""))
+    return int(m.group(1)) if m else None
+
+
+def download(url: str, dest: Path) -> Path:
+    _ensure_dir(dest.parent)
+    resp: http.client.HTTPResponse | None = open_url(url)
+    try:
+        # Bepaal het type uit de eerste bytes terwijl ze binnenkomen, zodat het bestand
+        # achteraf niet opnieuw geopend hoeft te worden om de extensie te herstellen.
+        head = resp.read(DOWNLOAD_CHUNK)
+        if dest.suffix == ".bin":
+            ext = sniff_ext(head)
+            if ext:
+                dest = dest.with_suffix(ext)
+
+        with open(dest, "wb", buffering=DOWNLOAD_CHUNK) as f:
+            length = resp.headers.get("Content-Length")
+            total = int(length) if length and length.isdigit() else None
+            if total and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, total)
+                except OSError:
+                    pass
+            f.write(head)
+
+            retries = 0
+            while True:
+                try:
+                    if resp is None:
+                        resp = open_url(url, f.tell())
+                        if resp.status != 206 or content_range_start(resp) != f.tell():
+                            # Server negeert Range of hervat op een andere offset: alles opnieuw.
+                            if resp.status == 206:
+                                resp.close()
+                                resp = None
+                                resp = open_url(url)
+                            f.seek(0)
+                    chunk = resp.read(DOWNLOAD_CHUNK)
+                    if not chunk and total is not None and f.tell() < total:
+                        raise http.client.IncompleteRead(b"", total - f.tell())
+                except (OSError, http.client.HTTPException):
+                    # Verbinding weggevallen of herverbinden mislukt: hervat vanaf wat er al binnen is.
+                    retries += 1
+                    if retries > DOWNLOAD_RETRIES:
+                        raise
+                    if resp is not None:
+                        resp.close()
+                        resp = None
+                    continue
+                if not chunk:
+                    break
+                f.write(chunk)
+            f.truncate()
+    finally:
+        if resp is not None:
+            resp.close()
+    return dest
 
 
 def is_image(path: Path) -> bool:
@@ -137,8 +269,41 @@ def pad_box(src_w: int, src_h: int, target_w: int, target_h: int) -> tuple[int,
     return new_w, new_h
 
 
-def format_image(
-    inp: Path,
+def draft_size(
+    src_w: int,
+    src_h: int,
+    targets: list[tuple[int, int]],
+    mode: str,
+) -> tuple[int, int]:
+    scale = 0.0
+    for target_w, target_h in targets:
+        if mode == "crop":
+            _, _, cw, ch = crop_box_centered(src_w, src_h, target_w, target_h, 0.5, 0.5)
+            scale = max(scale, target_w / cw, target_h / ch)
+        else:
+            scale = max(scale, min(target_w / src_w, target_h / src_h))
+
+    # 2x marge boven de doelresolutie, zodat LANCZOS nog genoeg detail heeft.
+    scale = min(1.0, 2 * scale)
+    return math.ceil(src_w * scale), math.ceil(src_h * scale)
+
+
+def _load_image(inp: Path, targets: list[tuple[int, int]] | None = None, mode: str = "crop") -> Image.Image:
+    from PIL import Image
+
+    img = Image.open(inp)
+    if targets:
+        # Alleen JPEG ondersteunt draft: libjpeg decodeert dan direct op 1/2, 1/4 of 1/8 schaal.
+        img.draft("RGB", draft_size(img.width, img.height, targets, mode))
+    if img.mode not in DEFERRED_CONVERT_MODES:
+        return img.convert("RGB")
+    # De omzetting naar RGB gebeurt pas na crop/resize, over de kleinere output.
+    img.load()
+    return img
+
+
+def _render_rgb(
+    img: Image.Image,
     outp: Path,
     target_w: int,
     target_h: int,
@@ -146,24 +311,36 @@ def format_image(
     focal_x: float,
     focal_y: float,
 ) -> None:
-    img = Image.open(inp).convert("RGB")
+    from PIL import Image
+
     src_w, src_h = img.size
 
     if mode == "crop":
         left, top, cw, ch = crop_box_centered(src_w, src_h, target_w, target_h, focal_x, focal_y)
-        img = img.crop((left, top, left + cw, top + ch))
-        img = img.resize((target_w, target_h), Image.Resampling.LANCZOS)
+        img = img.resize(
+            (target_w, target_h),
+            Image.Resampling.LANCZOS,
+            box=(left, top, left + cw, top + ch),
+            reducing_gap=3.0,
+        )
+        if img.mode != "RGB":
+            img = img.convert("RGB")
     else:
         new_w, new_h = pad_box(src_w, src_h, target_w, target_h)
-        resized = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-        canvas = Image.new("RGB", (target_w, target_h), (0, 0, 0))
-        x = (target_w - new_w) // 2
-        y = (target_h - new_h) // 2
-        canvas.paste(resized, (x, y))
-        img = canvas
-
-    outp.parent.mkdir(parents=True, exist_ok=True)
-    img.save(outp, quality=92, optimize=True)
+        resized = img.resize((new_w, new_h), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        if resized.mode != "RGB":
+            resized = resized.convert("RGB")
+        if (new_w, new_h) == (target_w, target_h):
+            img = resized
+        else:
+            canvas = Image.new("RGB", (target_w, target_h), (0, 0, 0))
+            x = (target_w - new_w) // 2
+            y = (target_h - new_h) // 2
+            canvas.paste(resized, (x, y))
+            img = canvas
+
+    _ensure_dir(outp.parent)
+    img.save(outp, "JPEG", quality=92, optimize=False, progressive=False, subsampling=2)
 
 
 def ffprobe_dims(path: Path) -> tuple[int, int]:
@@ -189,50 +366,130 @@ def ffprobe_dims(path: Path) -> tuple[int, int]:
     return w, h
 
 
-def format_video(
-    inp: Path,
-    outp: Path,
+def video_filter(
+    src_w: int,
+    src_h: int,
     target_w: int,
     target_h: int,
     mode: str,
     focal_x: float,
     focal_y: float,
-) -> None:
-    src_w, src_h = ffprobe_dims(inp)
-    outp.parent.mkdir(parents=True, exist_ok=True)
-
+) -> str:
     if mode == "crop":
         left, top, cw, ch = crop_box_centered(src_w, src_h, target_w, target_h, focal_x, focal_y)
-        vf = f"crop={cw}:{ch}:{left}:{top},scale={target_w}:{target_h}"
-    else:
-        new_w, new_h = pad_box(src_w, src_h, target_w, target_h)
-        pad_x = (target_w - new_w) // 2
-        pad_y = (target_h - new_h) // 2
-        vf = f"scale={new_w}:{new_h},pad={target_w}:{target_h}:{pad_x}:{pad_y}:black"
+        return f"crop={cw}:{ch}:{left}:{top},scale={target_w}:{target_h}"
+
+    new_w, new_h = pad_box(src_w, src_h, target_w, target_h)
+    pad_x = (target_w - new_w) // 2
+    pad_y = (target_h - new_h) // 2
+    return f"scale={new_w}:{new_h},pad={target_w}:{target_h}:{pad_x}:{pad_y}:black"
+
+
+def video_codec_args(encoder: str, preset: str, threads: int, tune: str | None) -> list[str]:
+    if encoder == "h264_nvenc":
+        return ["-c:v", encoder, "-preset", "p5", "-rc", "vbr", "-cq", "23", "-b:v", "0", "-pix_fmt", "yuv420p"]
+    if encoder == "h264_qsv":
+        return ["-c:v", encoder, "-global_quality", "23", "-pix_fmt", "nv12"]
+    if encoder == "h264_videotoolbox":
+        return ["-c:v", encoder, "-q:v", "65", "-pix_fmt", "yuv420p"]
+
+    args = ["-c:v", "libx264", "-threads", str(threads), "-preset", preset]
+    if tune:
+        args += ["-tune", tune]
+    # Korte social clips: geen scenecut detectie en adaptieve quantisatie, kortere lookahead.
+    args += ["-x264-params", "rc-lookahead=20:aq-mode=0:scenecut=0"]
+    args += ["-crf", "20", "-pix_fmt", "yuv420p"]
+    return args
+
+
+@functools.cache
+def pick_encoder(sessions: int = 1) -> str:
+    try:
+        available = run_capture(["ffmpeg", "-hide_banner", "-encoders"])
+    except (OSError, RuntimeError):
+        return "libx264"
+
+    # ffmpeg builds vermelden hardware encoders ook zonder bijbehorende hardware,
+    # dus een korte proef-encode beslist of een encoder echt bruikbaar is. De proef opent
+    # evenveel sessies als de echte run, want consumenten-GPU's begrenzen dat aantal.
+    labels = "".join(f"[t{i}]" for i in range(sessions))
+    for encoder in HW_ENCODERS:
+        if encoder not in available:
+            continue
+        cmd = [
+            "ffmpeg",
+            "-hide_banner",
+            "-nostats",
+            "-f",
+            "lavfi",
+            "-i",
+            "color=c=black:s=256x256:d=0.1",
+            "-filter_complex",
+            f"[0:v]split={sessions}{labels}",
+        ]
+        for i in range(sessions):
+            cmd += ["-map", f"[t{i}]", "-frames:v", "1"]
+            cmd += video_codec_args(encoder, "faster", 0, None)
+            cmd += ["-f", "null", "-"]
+        try:
+            run(cmd)
+        except RuntimeError:
+            continue
+        return encoder
+
+    return "libx264"
+
+
+def format_videos(
+    inp: Path,
+    outputs: list[tuple[Path, int, int]],
+    mode: str,
+    focal_x: float,
+    focal_y: float,
+    src_dims: tuple[int, int] | None = None,
+    preset: str = "faster",
+    threads: int | None = None,
+    tune: str | None = None,
+    encoder: str = "libx264",
+) -> None:
+    src_w, src_h = src_dims if src_dims is not None else ffprobe_dims(inp)
+    if threads is None:
+        # Alle encoders draaien tegelijk in hetzelfde proces; verdeel de cores over de outputs.
+        threads = max(1, (os.cpu_count() or 1) // len(outputs))
+
+    # Eén ffmpeg proces: de bron wordt één keer gedecodeerd en via split over alle outputs verdeeld.
+    labels = [f"[s{i}]" for i in range(len(outputs))]
+    chains = [f"[0:v]split={len(outputs)}{''.join(labels)}"]
+    for i, (_, target_w, target_h) in enumerate(outputs):
+        vf = video_filter(src_w, src_h, target_w, target_h, mode, focal_x, focal_y)
+        chains.append(f"{labels[i]}{vf}[v{i}]")
 
     cmd = [
         "ffmpeg",
         "-y",
+        "-nostats",
+        "-fflags",
+        "+genpts",
         "-i",
         str(inp),
-        "-vf",
-        vf,
-        "-c:v",
-        "libx264",
-        "-preset",
-        "medium",
-        "-crf",
-        "20",
-        "-pix_fmt",
-        "yuv420p",
-        "-c:a",
-        "aac",
-        "-b:a",
-        "192k",
-        "-movflags",
-        "+faststart",
-        str(outp),
+        "-filter_complex",
+        ";".join(chains),
     ]
+    for i, (outp, _, _) in enumerate(outputs):
+        _ensure_dir(outp.parent)
+        cmd += ["-map", f"[v{i}]", "-map", "0:a:0?"]
+        cmd += video_codec_args(encoder, preset, threads, tune)
+        cmd += [
+            "-c:a",
+            "aac",
+            "-b:a",
+            "192k",
+            "-avoid_negative_ts",
+            "make_zero",
+            "-movflags",
+            "+faststart",
+            str(outp),
+        ]
     run(cmd)
 
 
@@ -241,6 +498,8 @@ def detect_and_fix_extension(inp: Path) -> Path:
         return inp
 
     try:
+        from PIL import Image
+
         with Image.open(inp) as im:
             fmt = (im.format or "").lower()
         if fmt in {"jpeg", "jpg"}:
@@ -267,12 +526,65 @@ def detect_and_fix_extension(inp: Path) -> Path:
         raise RuntimeError("Kon bestandstype niet bepalen. Gebruik een URL met een herkenbare extensie.") from e
 
 
+def platform_groups() -> dict[tuple[int, int], list[str]]:
+    groups: dict[tuple[int, int], list[str]] = {}
+    for platform, dims in PLATFORMS.items():
+        groups.setdefault((dims["w"], dims["h"]), []).append(platform)
+    return groups
+
+
+def link_output(src: Path, dest: Path) -> None:
+    dest.unlink(missing_ok=True)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def _render_one(
+    platform: str,
+    dims: dict[str, int],
+    base_img: Image.Image,
+    base: str,
+    mode: str,
+    focal_x: float,
+    focal_y: float,
+    out_dir: Path,
+) -> Path:
+    outp = out_dir / f"{base}_{platform}.jpg"
+    _render_rgb(base_img, outp, dims["w"], dims["h"], mode, focal_x, focal_y)
+    return outp
+
+
 def main() -> int:
     p = argparse.ArgumentParser()
     p.add_argument("--media-url", required=True)
     p.add_argument("--mode", required=True, choices=["crop", "pad"])
     p.add_argument("--focal-x", required=False, default="0.5")
     p.add_argument("--focal-y", required=False, default="0.5")
+    p.add_argument(
+        "--x264-preset",
+        required=False,
+        default="faster",
+        choices=["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow"],
+    )
+    p.add_argument(
+        "--x264-tune",
+        required=False,
+        default=None,
+        choices=["fastdecode", "stillimage", "film", "animation"],
+    )
+    p.add_argument("--threads", required=False, default=None, type=non_negative_int)
+    p.add_argument(
+        "--hwaccel",
+        required=False,
+        default="cpu",
+        choices=["auto", "cpu"],
+        help=(
+            "auto gebruikt een hardware encoder als die werkt; --x264-preset, --x264-tune "
+            "en --threads gelden dan niet, die zijn alleen voor libx264"
+        ),
+    )
     args = p.parse_args()
 
     focal_x = clamp01(float(args.focal_x))
@@ -280,32 +592,65 @@ def main() -> int:
 
     work = Path("work")
     out_dir = Path("out")
-    work.mkdir(parents=True, exist_ok=True)
-    out_dir.mkdir(parents=True, exist_ok=True)
+    _ensure_dir(work)
+    _ensure_dir(out_dir)
 
     base = derive_input_basename(args.media_url)
 
     ext = guess_ext_from_url(args.media_url) or ".bin"
     inp = work / f"input{ext}"
-    download(args.media_url, inp)
+    inp = download(args.media_url, inp)
     inp = detect_and_fix_extension(inp)
 
-    for platform, dims in PLATFORMS.items():
-        target_w = dims["w"]
-        target_h = dims["h"]
-
-        if is_image(inp):
-            outp = out_dir / f"{base}_{platform}.jpg"
-            format_image(inp, outp, target_w, target_h, args.mode, focal_x, focal_y)
-            continue
-
-        if is_video(inp):
-            outp = out_dir / f"{base}_{platform}.mp4"
-            format_video(inp, outp, target_w, target_h, args.mode, focal_x, focal_y)
-            continue
-
+    if not is_image(inp) and not is_video(inp):
         raise RuntimeError(f"Onbekend bestandstype: {inp.suffix}")
 
+    # Platformen met dezelfde afmetingen krijgen byte-identieke output: render één keer per groep.
+    groups = platform_groups()
+    suffix = ".mp4" if is_video(inp) else ".jpg"
+
+    if is_video(inp):
+        outputs = [
+            (out_dir / f"{base}_{platforms[0]}{suffix}", w, h)
+            for (w, h), platforms in groups.items()
+        ]
+        format_videos(
+            inp,
+            outputs,
+            args.mode,
+            focal_x,
+            focal_y,
+            preset=args.x264_preset,
+            threads=args.threads,
+            tune=args.x264_tune,
+            encoder=pick_encoder(len(outputs)) if args.hwaccel == "auto" else "libx264",
+        )
+    else:
+        # Eenmalig decoden; crop/resize maken nieuwe images, dus de threads delen base_img alleen-lezen.
+        base_img = _load_image(inp, list(groups), args.mode)
+
+        jobs = [(platforms[0], {"w": w, "h": h}) for (w, h), platforms in groups.items()]
+        workers = min(len(jobs), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(
+                executor.map(
+                    _render_one,
+                    [platform for platform, _ in jobs],
+                    [dims for _, dims in jobs],
+                    [base_img] * len(jobs),
+                    [base] * len(jobs),
+                    [args.mode] * len(jobs),
+                    [focal_x] * len(jobs),
+                    [focal_y] * len(jobs),
+                    [out_dir] * len(jobs),
+                )
+            )
+
+    for platforms in groups.values():
+        first = out_dir / f"{base}_{platforms[0]}{suffix}"
+        for platform in platforms[1:]:
+            link_output(first, out_dir / f"{base}_{platform}{suffix}")
+
     return 0
 
 